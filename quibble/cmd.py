@@ -27,6 +27,7 @@ import quibble.mediawiki.maintenance
 import quibble.backend
 import quibble.zuul
 import quibble.commands
+import quibble.runner
 
 
 # Used for add_argument(choices=) let us validate multiple choices at once.
@@ -309,8 +310,11 @@ class QuibbleCmd(object):
             projects=self.args.projects,
             clone_vendor=(self.args.packages_source == 'vendor'))
 
+        # Installing composer dependencies waits for these commands, but not
+        # for the submodule update, so composer fetches packages meanwhile.
+        composer_prerequisites = []
         if not self.args.skip_zuul:
-            plan.append(quibble.commands.ZuulCloneCommand(
+            composer_prerequisites.append(quibble.commands.ZuulCloneCommand(
                 branch=self.args.branch,
                 cache_dir=self.args.git_cache,
                 project_branch=self.args.project_branch,
@@ -323,6 +327,7 @@ class QuibbleCmd(object):
                 zuul_ref=os.getenv('ZUUL_REF'),
                 zuul_url=os.getenv('ZUUL_URL')
             ))
+            plan.extend(composer_prerequisites)
             plan.append(quibble.commands.ExtSkinSubmoduleUpdateCommand(
                 self.mw_install_path))
 
@@ -334,14 +339,20 @@ class QuibbleCmd(object):
                     self.mw_install_path,
                     quibble.zuul.repo_dir(os.environ['ZUUL_PROJECT']))
 
-                plan.append(quibble.commands.ExtSkinComposerNpmTest(
-                    project_dir, run_composer, run_npm))
+                ext_skin_test = quibble.commands.ExtSkinComposerNpmTest(
+                    project_dir, run_composer, run_npm)
+                # Do not run composer concurrently with the extension tests
+                composer_prerequisites.append(ext_skin_test)
+                plan.append(ext_skin_test)
 
         if not self.args.skip_deps and self.args.packages_source == 'composer':
-            plan.append(quibble.commands.CreateComposerLocal(
-                self.mw_install_path, self.dependencies))
-            plan.append(quibble.commands.NativeComposerDependencies(
-                self.mw_install_path))
+            create_composer_local = quibble.commands.CreateComposerLocal(
+                self.mw_install_path, self.dependencies)
+            create_composer_local.depends_on = composer_prerequisites
+            native_composer = quibble.commands.NativeComposerDependencies(
+                self.mw_install_path)
+            native_composer.depends_on = [create_composer_local]
+            plan.extend([create_composer_local, native_composer])
 
         if not self.args.skip_install:
             plan.append(quibble.commands.InstallMediaWiki(
@@ -401,13 +412,13 @@ class QuibbleCmd(object):
         return plan
 
     def execute(self, plan):
-        self.log.debug("Execution plan:")
-        for cmd in plan:
-            self.log.debug(cmd)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Execution plan:")
+            for cmd in plan:
+                self.log.debug(cmd)
         if self.args.dry_run:
             return
-        for command in plan:
-            command.execute()
+        quibble.commands.execute_plan(plan)
 
 
 def get_arg_parser():
@@ -428,6 +439,7 @@ def main():
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('quibble').setLevel(logging.DEBUG)
     quibble.colored_logging()
+    quibble.runner.start()
 
     cmd = QuibbleCmd()
     args = cmd.parse_arguments()
@@ -1,18 +1,110 @@
-"""Encapsulates each step of a job"""
+"""
+Encapsulates each step of a job
 
+A command may have a `depends_on` attribute listing the commands it needs to
+run after. Commands without it depend on every command before them in the
+execution plan. Commands using the shared worker pool of quibble.util set
+`uses_pool`. See execute_plan().
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import ExitStack
 import json
 import logging
 import os
 import os.path
-import pkg_resources
 from quibble.gitchangedinhead import GitChangedInHead
-from quibble.util import copylog, parallel_run
+from quibble.util import copylog, get_pool, json_dumps, json_loads, \
+    parallel_run
+import quibble.runner
 import quibble.zuul
+import shlex
+import shutil
 import subprocess
 
 log = logging.getLogger(__name__)
 HTTP_PORT = 9412
+CHROME_BIN = '/usr/bin/chromium'
+# Characters having a meaning for the shell, besides quoting
+SHELL_SPECIAL_CHARS = frozenset(';|&<>()$`*?[]{}~=#!\n')
+# PHPUnit groups never run
+PHPUNIT_ALWAYS_EXCLUDED = ('Broken', 'ParserFuzz', 'Stub')
+LOCAL_SETTINGS = os.path.join(
+    os.path.dirname(__file__), 'mediawiki', 'local_settings.php')
+
+
+def execute_plan(plan):
+    """
+    Execute a list of commands, concurrently when they do not depend on each
+    other.
+
+    Commands are started as soon as the commands they depend on have
+    completed. On failure or KeyboardInterrupt, no further command is
+    started, the commands run by quibble.runner are terminated and the
+    exception is raised once running commands have stopped.
+    """
+    dependencies = {}
+    for i, command in enumerate(plan):
+        depends_on = getattr(command, 'depends_on', None)
+        if depends_on is None:
+            depends_on = plan[:i]
+        dependencies[command] = [dep for dep in depends_on if dep in plan]
+
+    if not plan:
+        return
+
+    if any(getattr(command, 'uses_pool', False) for command in plan):
+        # Fork the worker processes before we start any thread.
+        get_pool()
+
+    pending = list(plan)
+    running = {}
+    completed = set()
+    with ThreadPoolExecutor(max_workers=len(plan)) as executor:
+        try:
+            while pending or running:
+                for command in list(pending):
+                    if completed.issuperset(dependencies[command]):
+                        pending.remove(command)
+                        log.debug('Starting: %s', command)
+                        running[executor.submit(command.execute)] = command
+
+                if not running:
+                    raise Exception('Circular dependencies between: %s' % (
+                        ', '.join(str(command) for command in pending)))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    command = running.pop(future)
+                    # Raises the command exception, if any.
+                    future.result()
+                    completed.add(command)
+        except BaseException:
+            # Else leaving the executor waits for the running commands.
+            quibble.runner.terminate_all()
+            raise
+
+
+def chained_commands(*cmds):
+    """
+    Build a single bash invocation running the given shell commands in turn.
+
+    Saves spawning a process per command. Execution stops on the first
+    failure, whose exit code is returned.
+    """
+    return ['bash', '-ec', ' && '.join(cmds)]
+
+
+def npm_install_commands(directory):
+    """
+    Shell commands installing the npm dependencies of a directory.
+
+    `npm ci` does a single clean install from package-lock.json, without it
+    we have to prune then install.
+    """
+    if os.path.exists(os.path.join(directory, 'package-lock.json')):
+        return ['npm ci --no-progress --no-audit --prefer-offline']
+    return ['npm prune', 'npm install --no-progress']
 
 
 class ZuulCloneCommand:
@@ -30,6 +122,7 @@ class ZuulCloneCommand:
         self.zuul_project = zuul_project
         self.zuul_ref = zuul_ref
         self.zuul_url = zuul_url
+        self._description = None
 
     def execute(self):
         quibble.zuul.clone(
@@ -38,44 +131,57 @@ class ZuulCloneCommand:
             self.zuul_project, self.zuul_ref, self.zuul_url)
 
     def __str__(self):
-        pruned_params = {k: v for k, v in self.__dict__.items()
-                         if v is not None and v != []}
-        return "Zuul clone with parameters {}".format(
-            json.dumps(pruned_params))
+        # Parameters do not change, only serialize them once.
+        if self._description is None:
+            pruned_params = {k: v for k, v in self.__dict__.items()
+                             if not k.startswith('_')
+                             and v is not None and v != []}
+            self._description = "Zuul clone with parameters {}".format(
+                json.dumps(pruned_params))
+        return self._description
 
 
 class ExtSkinSubmoduleUpdateCommand:
+    uses_pool = True
+
     def __init__(self, mw_install_path):
         self.mw_install_path = mw_install_path
 
     def execute(self):
         log.info('Updating git submodules of extensions and skins')
 
-        cmds = [
-            ['git', 'submodule', 'foreach', 'git', 'clean', '-xdff', '-q'],
-            ['git', 'submodule', 'update', '--init', '--recursive'],
-            ['git', 'submodule', 'status'],
-        ]
+        dirs = list(self._collect_submodule_dirs())
+        # Raises the first error encountered.
+        list(get_pool().map(self._run_submodule_cmds, dirs, chunksize=1))
 
+    def _collect_submodule_dirs(self):
         tops = [os.path.join(self.mw_install_path, top)
                 for top in ['extensions', 'skins']]
 
         for top in tops:
-            for dirpath, dirnames, filenames in os.walk(top):
-                if dirpath not in tops:
-                    # Only look at the first level
-                    dirnames[:] = []
-                if '.gitmodules' not in filenames:
-                    continue
-
-                for cmd in cmds:
-                    try:
-                        subprocess.check_call(cmd, cwd=dirpath)
-                    except subprocess.CalledProcessError as e:
-                        log.error(
-                            "Failed to process git submodules for {}".format(
-                                dirpath))
-                        raise e
+            if not os.path.isdir(top):
+                continue
+            # Only look at the first level. The iterator is exhausted, which
+            # closes it (it is not a context manager before Python 3.6).
+            for entry in list(os.scandir(top)):
+                if entry.is_dir(follow_symlinks=False) and \
+                        os.path.exists(
+                            os.path.join(entry.path, '.gitmodules')):
+                    yield entry.path
+
+    def _run_submodule_cmds(self, dirpath):
+        cmd = chained_commands(
+            'git submodule foreach git clean -xdff -q',
+            'git submodule update --init --recursive',
+            'git submodule status',
+        )
+
+        try:
+            quibble.runner.run(cmd, cwd=dirpath)
+        except subprocess.CalledProcessError as e:
+            log.error(
+                "Failed to process git submodules for {}".format(dirpath))
+            raise e
 
     def __str__(self):
         # TODO: Would be nicer to extract the directory crawl into a subroutine
@@ -103,7 +209,7 @@ class CreateComposerLocal:
         composer_local = os.path.join(self.mw_install_path,
                                       'composer.local.json')
         with open(composer_local, 'w') as f:
-            json.dump(out, f)
+            f.write(json_dumps(out))
         log.info('Created composer.local.json')
 
     def __str__(self):
@@ -112,6 +218,8 @@ class CreateComposerLocal:
 
 
 class ExtSkinComposerNpmTest:
+    uses_pool = True
+
     def __init__(self, directory, composer, npm):
         self.directory = directory
         self.composer = composer
@@ -128,8 +236,8 @@ class ExtSkinComposerNpmTest:
         parallel_run(tasks)
 
         log.info('%s: git clean -xqdf' % self.directory)
-        subprocess.check_call(['git', 'clean', '-xqdf'],
-                              cwd=self.directory)
+        quibble.runner.run(['git', 'clean', '-xqdf'],
+                           cwd=self.directory)
 
     def run_extskin_composer(self):
         project_name = os.path.basename(self.directory)
@@ -139,14 +247,12 @@ class ExtSkinComposerNpmTest:
             return
 
         log.info('Running "composer test" for %s' % project_name)
-        cmds = [
-            ['composer', '--ansi', 'validate', '--no-check-publish'],
-            ['composer', '--ansi', 'install', '--no-progress',
-             '--prefer-dist', '--profile', '-v'],
-            ['composer', '--ansi', 'test'],
-        ]
-        for cmd in cmds:
-            subprocess.check_call(cmd, cwd=self.directory)
+        cmd = chained_commands(
+            'composer --ansi validate --no-check-publish',
+            'composer --ansi install --no-progress --prefer-dist --profile -v',
+            'composer --ansi test',
+        )
+        quibble.runner.run(cmd, cwd=self.directory)
 
     def run_extskin_npm(self):
         project_name = os.path.basename(self.directory)
@@ -158,13 +264,11 @@ class ExtSkinComposerNpmTest:
             return
 
         log.info('Running "npm test" for %s' % project_name)
-        cmds = [
-            ['npm', 'prune'],
-            ['npm', 'install', '--no-progress'],
-            ['npm', 'test'],
-        ]
-        for cmd in cmds:
-            subprocess.check_call(cmd, cwd=self.directory)
+        cmd = chained_commands(
+            *npm_install_commands(self.directory),
+            'npm test'
+        )
+        quibble.runner.run(cmd, cwd=self.directory)
 
     def __str__(self):
         tests = []
@@ -176,6 +280,8 @@ class ExtSkinComposerNpmTest:
 
 
 class CoreNpmComposerTest:
+    uses_pool = True
+
     def __init__(self, mw_install_path, composer, npm):
         self.mw_install_path = mw_install_path
         self.composer = composer
@@ -201,10 +307,9 @@ class CoreNpmComposerTest:
             # to parallel-lint and phpcs
             files = ['.']
         else:
-            files = GitChangedInHead(
-                ['php', 'php5', 'inc', 'sample'],
-                cwd=self.mw_install_path
-            ).changedFiles()
+            # Filter in place rather than asking git again
+            files = [f for f in changed
+                     if f.endswith(('.php', '.php5', '.inc', '.sample'))]
 
         if not files:
             log.info('Skipping composer test (unneeded)')
@@ -216,12 +321,12 @@ class CoreNpmComposerTest:
 
             composer_test_cmd = ['composer', 'test']
             composer_test_cmd.extend(files)
-            subprocess.check_call(
+            quibble.runner.run(
                 composer_test_cmd, cwd=self.mw_install_path, env=env)
 
     def run_npm_test(self):
         log.info("Running npm test")
-        subprocess.check_call(['npm', 'test'], cwd=self.mw_install_path)
+        quibble.runner.run(['npm', 'test'], cwd=self.mw_install_path)
 
     def __str__(self):
         tests = []
@@ -242,7 +347,7 @@ class NativeComposerDependencies:
                '--ansi', '--no-progress', '--prefer-dist',
                '--profile', '-v',
                ]
-        subprocess.check_call(cmd, cwd=self.mw_install_path)
+        quibble.runner.run(cmd, cwd=self.mw_install_path)
 
     def __str__(self):
         return "Run composer update for mediawiki/core"
@@ -259,7 +364,7 @@ class VendorComposerDependencies:
         mw_composer_json = os.path.join(self.mw_install_path, 'composer.json')
         vendor_dir = os.path.join(self.mw_install_path, 'vendor')
         with open(mw_composer_json, 'r') as f:
-            composer = json.load(f)
+            composer = json_loads(f.read())
 
         reqs = ['='.join([dependency, version])
                 for dependency, version in composer['require-dev'].items()]
@@ -269,13 +374,13 @@ class VendorComposerDependencies:
                             '--no-progress', '--prefer-dist', '-v']
         composer_require.extend(reqs)
 
-        subprocess.check_call(composer_require, cwd=vendor_dir)
+        quibble.runner.run(composer_require, cwd=vendor_dir)
 
         # Point composer-merge-plugin to mediawiki/core.
         # That let us easily merge autoload-dev section and thus complete
         # the autoloader.
         # T158674
-        subprocess.check_call([
+        quibble.runner.run([
             'composer', 'config',
             'extra.merge-plugin.include', mw_composer_json],
             cwd=vendor_dir)
@@ -283,7 +388,7 @@ class VendorComposerDependencies:
         # FIXME integration/composer used to be outdated and broke the
         # autoloader. Since composer 1.0.0-alpha11 the following might not
         # be needed anymore.
-        subprocess.check_call([
+        quibble.runner.run([
             'composer', 'dump-autoload', '--optimize'],
             cwd=vendor_dir)
 
@@ -303,8 +408,9 @@ class NpmInstall:
         self.directory = directory
 
     def execute(self):
-        subprocess.check_call(['npm', 'prune'], cwd=self.directory)
-        subprocess.check_call(['npm', 'install'], cwd=self.directory)
+        quibble.runner.run(
+            chained_commands(*npm_install_commands(self.directory)),
+            cwd=self.directory)
 
     def __str__(self):
         return "npm install in {}".format(self.directory)
@@ -357,18 +463,18 @@ class InstallMediaWiki:
 
         localsettings = os.path.join(self.mw_install_path, 'LocalSettings.php')
         # Prepend our custom configuration snippets
-        with open(localsettings, 'r+') as lf:
-            quibblesettings = pkg_resources.resource_filename(
-                __name__, 'mediawiki/local_settings.php')
-            with open(quibblesettings) as qf:
-                quibble_conf = qf.read()
-
+        with open(LOCAL_SETTINGS) as qf:
+            quibble_conf = qf.read()
+        with open(localsettings) as lf:
             installed_conf = lf.read()
-            lf.seek(0, 0)
+
+        # Write to a temporary file then atomically move it in place.
+        with open(localsettings + '.tmp', 'w') as lf:
             lf.write(quibble_conf + '\n?>' + installed_conf)
+        os.replace(localsettings + '.tmp', localsettings)
         copylog(localsettings,
                 os.path.join(self.log_dir, 'LocalSettings.php'))
-        subprocess.check_call(['php', '-l', localsettings])
+        quibble.runner.run(['php', '-l', localsettings])
 
         update_args = []
         if self.use_vendor:
@@ -402,8 +508,6 @@ class AbstractPhpUnit:
     def run_phpunit(self, group=[], exclude_group=[]):
         log.info(self)
 
-        always_excluded = ['Broken', 'ParserFuzz', 'Stub']
-
         cmd = ['php', 'tests/phpunit/phpunit.php', '--debug-tests']
         if self.testsuite:
             cmd.extend(['--testsuite', self.testsuite])
@@ -412,7 +516,7 @@ class AbstractPhpUnit:
             cmd.extend(['--group', ','.join(group)])
 
         cmd.extend(['--exclude-group',
-                    ','.join(always_excluded + exclude_group)])
+                    ','.join(PHPUNIT_ALWAYS_EXCLUDED + tuple(exclude_group))])
 
         if self.junit_file:
             cmd.extend(['--log-junit', self.junit_file])
@@ -422,7 +526,13 @@ class AbstractPhpUnit:
         phpunit_env.update(os.environ)
         phpunit_env.update({'LANG': 'C.UTF-8'})
 
-        subprocess.check_call(cmd, cwd=self.mw_install_path, env=phpunit_env)
+        output_log = None
+        if self.junit_file:
+            # Keep the console output next to the junit report
+            output_log = os.path.splitext(self.junit_file)[0] + '.log'
+
+        quibble.runner.run(cmd, log_file=output_log,
+                           cwd=self.mw_install_path, env=phpunit_env)
 
 
 class PhpUnitDatabaseless(AbstractPhpUnit):
@@ -469,9 +579,17 @@ class BrowserTests:
         self.display = display
 
     def execute(self):
+        # Load the binaries in the page cache while the web server starts.
+        warmers = ThreadPoolExecutor(max_workers=2)
+        warmers.submit(self.warm_up, ['node', '--version'])
+        warmers.submit(self.warm_up, [CHROME_BIN, '--version'])
+
         with quibble.backend.DevWebServer(
                 mwdir=self.mw_install_path,
                 port=HTTP_PORT):
+            # Do not compete with the tests
+            warmers.shutdown(wait=True)
+
             if self.qunit:
                 self.run_qunit()
 
@@ -489,9 +607,17 @@ class BrowserTests:
                     with quibble.backend.ChromeWebDriver(display=self.display):
                         self.run_webdriver()
 
+    @staticmethod
+    def warm_up(cmd):
+        try:
+            quibble.runner.run(cmd, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning('Failed to warm up %s: %s', cmd[0], e)
+
     def run_qunit(self):
         karma_env = {
-             'CHROME_BIN': '/usr/bin/chromium',
+             'CHROME_BIN': CHROME_BIN,
              'MW_SERVER': 'http://127.0.0.1:%s' % HTTP_PORT,
              'MW_SCRIPT_PATH': '/',
              'FORCE_COLOR': '1',  # for 'supports-color'
@@ -499,7 +625,7 @@ class BrowserTests:
         karma_env.update(os.environ)
         karma_env.update({'CHROMIUM_FLAGS': quibble.chromium_flags()})
 
-        subprocess.check_call(
+        quibble.runner.run(
             ['./node_modules/.bin/grunt', 'qunit'],
             cwd=self.mw_install_path,
             env=karma_env,
@@ -517,7 +643,7 @@ class BrowserTests:
             'DISPLAY': self.display,
         })
 
-        subprocess.check_call(
+        quibble.runner.run(
             ['npm', 'run', 'selenium-test'],
             cwd=self.mw_install_path,
             env=webdriver_env)
@@ -547,8 +673,27 @@ class UserCommands:
 
             for cmd in self.commands:
                 log.info(cmd)
-                subprocess.check_call(
-                    cmd, shell=True, cwd=self.mw_install_path)
+                if self.needs_shell(cmd):
+                    quibble.runner.run(
+                        cmd, shell=True, cwd=self.mw_install_path)
+                else:
+                    quibble.runner.run(
+                        shlex.split(cmd), cwd=self.mw_install_path)
+
+    @staticmethod
+    def needs_shell(cmd):
+        """
+        Whether cmd relies on the shell, else it can be executed directly
+        """
+        if any(c in cmd for c in SHELL_SPECIAL_CHARS):
+            return True
+        try:
+            argv = shlex.split(cmd)
+        except ValueError:
+            # Let the shell report the syntax error
+            return True
+        # Shell builtins such as `cd` or `export`
+        return not argv or shutil.which(argv[0]) is None
 
     def __str__(self):
         return "User commands: {}".format(", ".join(self.commands))
@@ -0,0 +1,358 @@
+# Copyright 2018, Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""
+Run external commands from a small helper process.
+
+Forking a process has to copy its page tables, which gets slower as the
+process grows. start() forks a helper process early, while Quibble is still
+small, and run() then asks that helper to spawn commands on our behalf.
+
+Requests are pickled `(cmd, kwargs)` tuples sent over a UNIX socket, the
+helper replies with the exit code. A `None` request asks the helper to
+terminate all the commands it runs. Each request uses its own connection so
+that commands can be run concurrently, including from the worker processes
+of quibble.util.parallel_run(). File descriptors, such as the output of
+commands whose output is logged, are passed along with the first byte of a
+request.
+
+When the helper is not started, run() falls back to subprocess.check_call().
+"""
+
+import array
+import atexit
+import errno
+import logging
+import os
+import pickle
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# Path of the UNIX socket the helper listens on. None when not started.
+_ADDRESS = None
+_PID = None
+_LIFELINE = None
+_OWNER = None
+# In the helper, processes being run
+_RUNNING = set()
+
+_HEADER = struct.Struct('!I')
+
+
+def start():
+    """
+    Fork the helper process.
+
+    Should be called as early as possible, before the process grows.
+    """
+    global _ADDRESS, _PID, _LIFELINE, _OWNER
+    if _PID is not None:
+        return
+
+    address = os.path.join(tempfile.mkdtemp(prefix='quibble-runner-'),
+                           'socket')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen()
+
+    # The helper exits when the write end is closed, which happens when we
+    # stop() or die.
+    lifeline_r, lifeline_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(lifeline_w)
+        status = 0
+        try:
+            _serve(listener, lifeline_r)
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+
+    os.close(lifeline_r)
+    listener.close()
+    _ADDRESS, _PID, _LIFELINE = address, pid, lifeline_w
+    _OWNER = os.getpid()
+    atexit.register(stop)
+    log.debug('Started runner process %s listening on %s', pid, address)
+
+
+def stop():
+    """Terminate the helper process"""
+    global _ADDRESS, _PID, _LIFELINE
+    # Forked children (eg parallel_run workers) share the helper.
+    if _PID is None or os.getpid() != _OWNER:
+        return
+
+    os.close(_LIFELINE)
+    os.waitpid(_PID, 0)
+    os.unlink(_ADDRESS)
+    os.rmdir(os.path.dirname(_ADDRESS))
+    _ADDRESS, _PID, _LIFELINE = None, None, None
+
+
+def run(cmd, log_file=None, **kwargs):
+    """
+    Run a command and wait for it to complete.
+
+    Accepts the keyword arguments of subprocess.check_call() that can be
+    pickled, such as `cwd`, `env`, `shell` or `stdout`, and likewise raises
+    CalledProcessError when the command exits with a non-zero code.
+
+    With `log_file`, the standard output of the command is written to that
+    file and to `stdout`, a file descriptor defaulting to our standard
+    output. The command then writes to a pipe instead of a terminal, some
+    commands thus disable colors. Its standard error is left untouched.
+    """
+    out_fd = None
+    if log_file is not None:
+        out_fd = kwargs.pop('stdout', None)
+        if out_fd is None:
+            sys.stdout.flush()
+            out_fd = sys.stdout.fileno()
+
+    if _ADDRESS is None:
+        if log_file is None:
+            return subprocess.check_call(cmd, **kwargs)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs)
+        _log_output(proc, log_file, out_fd)
+        returncode = proc.wait()
+    else:
+        # Resolve them now, the helper has a copy of our state at fork time.
+        kwargs.setdefault('cwd', os.getcwd())
+        if kwargs.get('env') is None:
+            kwargs['env'] = dict(os.environ)
+
+        fds = []
+        if log_file is not None:
+            kwargs['log_file'] = log_file
+            fds.append(out_fd)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(_ADDRESS)
+            _send(conn, (cmd, kwargs), fds)
+            returncode = _recv(conn)
+
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+
+def terminate_all():
+    """
+    Terminate the commands being run by the helper.
+
+    Commands are in their own process group and thus do not receive signals
+    sent to ours, such as SIGINT on ^C. Callers waiting for them get a
+    CalledProcessError.
+    """
+    if _ADDRESS is None:
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(_ADDRESS)
+        _send(conn, None)
+        _recv(conn)
+
+
+def _serve(listener, lifeline):
+    try:
+        while True:
+            readable, _, _ = select.select([listener, lifeline], [], [])
+            if lifeline in readable:
+                return
+            conn, _ = listener.accept()
+            threading.Thread(target=_handle, args=(conn,),
+                             daemon=True).start()
+    finally:
+        # Commands are in their own process group and thus do not receive
+        # signals sent to ours, such as SIGINT on ^C.
+        for proc in list(_RUNNING):
+            _terminate(proc)
+
+
+def _handle(conn):
+    with conn:
+        request, fds = _recv_request(conn)
+        if request is None:
+            for proc in list(_RUNNING):
+                _terminate(proc)
+            _send(conn, 0)
+            return
+
+        cmd, kwargs = request
+        log_file = kwargs.pop('log_file', None)
+        if log_file is not None:
+            kwargs['stdout'] = subprocess.PIPE
+        try:
+            # In a new session, so that _terminate() reaches the processes
+            # it spawns, eg the commands chained by `bash -ec`.
+            proc = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        except OSError as e:
+            log.error('Failed to run %s: %s', cmd, e)
+            for fd in fds:
+                os.close(fd)
+            _send(conn, 127)
+            return
+
+        _RUNNING.add(proc)
+        threading.Thread(target=_terminate_on_hangup, args=(conn, proc),
+                         daemon=True).start()
+        if log_file is not None:
+            try:
+                _log_output(proc, log_file, fds[0])
+            except OSError as e:
+                log.error('Failed to log output of %s: %s', cmd, e)
+            finally:
+                os.close(fds[0])
+        returncode = proc.wait()
+        _RUNNING.discard(proc)
+        try:
+            _send(conn, returncode)
+            # Wakes up _terminate_on_hangup()
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # The caller went away
+            pass
+
+
+def _terminate_on_hangup(conn, proc):
+    # The caller does not send anything after its request, we thus get an
+    # end of file once it either got the exit code or went away (eg a
+    # parallel_run worker being terminated).
+    try:
+        conn.recv(1)
+    except OSError:
+        pass
+    if proc.poll() is None:
+        log.warning('Caller went away, terminating %s', proc.args)
+        _terminate(proc)
+
+
+def _terminate(proc):
+    """Terminate the process group of a command"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def _log_output(proc, log_file, out_fd):
+    """Copy the standard output of proc to log_file and out_fd"""
+    try:
+        # Read back when copying to out_fd
+        with open(log_file, 'w+b') as log_f, proc.stdout:
+            _tee(proc.stdout.fileno(), log_f.fileno(), out_fd)
+    except BaseException:
+        # Nobody is reading its output anymore
+        proc.kill()
+        raise
+    finally:
+        proc.wait()
+
+
+def _tee(pipe_fd, file_fd, out_fd, chunk_size=65536):
+    """
+    Copy everything read from pipe_fd to file_fd and out_fd.
+
+    On Linux the data is spliced from the pipe into the file, then sent from
+    the file to out_fd, without being copied to user space. Reads and writes
+    are used when the system or the file descriptors do not support it, for
+    example when out_fd is in append mode.
+    """
+    use_splice = hasattr(os, 'splice')
+    use_sendfile = hasattr(os, 'sendfile')
+
+    offset = 0
+    while True:
+        size = None
+        if use_splice:
+            try:
+                size = os.splice(pipe_fd, file_fd, chunk_size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                use_splice = False
+        if size is None:
+            data = os.read(pipe_fd, chunk_size)
+            _write_all(file_fd, data)
+            size = len(data)
+        if not size:
+            return
+
+        end = offset + size
+        while offset < end:
+            if use_sendfile:
+                try:
+                    offset += os.sendfile(
+                        out_fd, file_fd, offset, end - offset)
+                    continue
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    use_sendfile = False
+            _write_all(out_fd, os.pread(file_fd, end - offset, offset))
+            offset = end
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _send(conn, obj, fds=()):
+    payload = pickle.dumps(obj)
+    data = _HEADER.pack(len(payload)) + payload
+    if fds:
+        conn.sendmsg([data[:1]], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                   array.array('i', fds))])
+        data = data[1:]
+    conn.sendall(data)
+
+
+def _recv(conn, received=b''):
+    header = received + _recv_exactly(conn, _HEADER.size - len(received))
+    size, = _HEADER.unpack(header)
+    return pickle.loads(_recv_exactly(conn, size))
+
+
+def _recv_request(conn):
+    """Receive a request and the file descriptors passed along with it"""
+    fds = array.array('i')
+    first, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_SPACE(fds.itemsize))
+    if not first:
+        raise EOFError('Runner connection closed')
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return _recv(conn, first), list(fds)
+
+
+def _recv_exactly(conn, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise EOFError('Runner connection closed')
+        buf += chunk
+    return buf
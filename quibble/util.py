@@ -14,21 +14,50 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+import json
 import logging
-from multiprocessing import Pool
+import multiprocessing
+import os
 from shutil import copyfile
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger(__name__)
 
+# Shared worker pool, lazily created by get_pool()
+_POOL = None
+
 
 def copylog(src, dest):
     log.info('Copying %s to %s' % (src, dest))
+    # The logs are a few kilobytes of composer.json, autoload_files.php or
+    # LocalSettings.php. Copying them through user space, as copyfile() does
+    # before Python 3.8, does not take measurably longer than os.sendfile().
     copyfile(src, dest)
 
 
+def json_dumps(obj):
+    """Serialize obj to a JSON string, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def json_loads(s):
+    """Deserialize a JSON string, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
 def task_wrapper(args):
     """
-    Helper for multiprocessing.Pool.imap_unordered.
+    Helper for submitting tasks to an executor in parallel_run().
 
     The first argument is a function to call.  Rest of the arguments are passed
     to the function.
@@ -44,14 +73,90 @@ def task_wrapper(args):
         return ret
 
 
-def parallel_run(tasks):
+def get_pool():
+    """
+    Return the worker pool shared by all commands.
+
+    The pool is created on first use and then reused, which saves spawning a
+    new set of worker processes for each parallel_run() call. Its workers are
+    forked right away, so that calling it before starting threads guarantees
+    no lock is held in the workers.
+    """
+    global _POOL
+    if _POOL is None:
+        # Commands run up to two tasks (composer and npm) side by side,
+        # which mostly wait for subprocesses.
+        pool_args = {'max_workers': max(2, os.cpu_count() or 1)}
+        if sys.version_info >= (3, 7):
+            # Fork, as it is the default on Linux before Python 3.14. Older
+            # Python versions do not support choosing the context.
+            pool_args['mp_context'] = multiprocessing.get_context('fork')
+        _POOL = ProcessPoolExecutor(**pool_args)
+        # Workers are only started on the first submission
+        _POOL.submit(int).result()
+    return _POOL
+
+
+def parallel_run(tasks, executor=None):
     """
     Tasks is an iterable of bound functions.  The wrapper makes it easy for us
     to run a list of different functions, rather than one function over a list
     of inputs.
+
+    Tasks are submitted to `executor`, which defaults to the shared pool
+    returned by get_pool().
+
+    As soon as a task fails, the other tasks are cancelled and the exception
+    is raised. When using the shared pool, its workers are terminated to stop
+    tasks that are already running and a new pool is created on next use.
+    """
+    if not tasks:
+        return True
+    if executor is None:
+        executor = get_pool()
+
+    futures = [executor.submit(task_wrapper, task) for task in tasks]
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in done:
+        if future.exception() is not None:
+            for other in not_done:
+                other.cancel()
+            if not_done and executor is _POOL:
+                terminate_pool()
+            raise future.exception()
+
+    return all(future.result() for future in futures)
+
+
+def terminate_pool():
+    """
+    Kill the workers of the shared pool and discard it.
+
+    The quibble.runner helper then terminates the commands the workers were
+    waiting for. Commands spawned by the workers themselves, when the helper
+    is not started, are left running.
     """
-    workers = max(1, len(tasks))
-    with Pool(processes=workers) as pool:
-        # As soon as any one task fails, the `all()` drops us out of the Pool's
-        # context manager, and any remaining threads are terminated.
-        return all(pool.imap_unordered(task_wrapper, tasks))
+    global _POOL
+    if _POOL is None:
+        return
+
+    pool, _POOL = _POOL, None
+    _terminate_workers(pool)
+    # Tasks not yet started fail with BrokenProcessPool
+    pool.shutdown(wait=True)
+
+
+def _terminate_workers(pool):
+    # ProcessPoolExecutor has a public method to do so since Python 3.14,
+    # older versions require reaching into its private attributes.
+    if hasattr(pool, 'terminate_workers'):
+        pool.terminate_workers()
+        return
+    # A worker killed while sending a result would keep the lock of the
+    # result queue, which shutdown() writes to before Python 3.8.
+    with pool._result_queue._wlock:
+        processes = list(pool._processes.values())
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -5,6 +5,8 @@ from setuptools import setup, find_packages
 setup(
     name='quibble',
     packages=find_packages(),
+    # Debian Stretch, used by the Docker image
+    python_requires='>=3.5',
     install_requires=[
         # For zuul-cloner
         'extras',
@@ -19,6 +21,10 @@ setup(
         # So we want either <2.1.2 or >2.1.7
         'GitPython<2.2.0,!=2.1.2,!=2.1.3,!=2.1.4,!=2.1.5,!=2.1.6,!=2.1.7'
         ],
+    extras_require={
+        # Faster JSON (de)serialization, used when available
+        'orjson': ['orjson'],
+    },
     package_data={
         'quibble.mediawiki': ['*.php'],
     },
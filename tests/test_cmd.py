@@ -298,3 +298,30 @@ class CmdTest(unittest.TestCase):
         plan = q.build_execution_plan(args)
 
         self.assertIsInstance(plan[0], quibble.commands.ZuulCloneCommand)
+
+    @mock.patch('os.makedirs')
+    def test_build_execution_plan_composer_dependencies(self, _):
+        q = cmd.QuibbleCmd()
+
+        args = q.parse_arguments(args=['--packages-source=composer'])
+        plan = q.build_execution_plan(args)
+
+        clone, submodules, composer_local, native_composer = plan[:4]
+        self.assertIsInstance(
+            submodules, quibble.commands.ExtSkinSubmoduleUpdateCommand)
+        self.assertEqual([clone], composer_local.depends_on)
+        self.assertEqual([composer_local], native_composer.depends_on)
+
+    @mock.patch.dict('os.environ', {'ZUUL_PROJECT': 'mediawiki/skins/Vector'})
+    @mock.patch('os.makedirs')
+    def test_build_execution_plan_composer_after_ext_skin_tests(self, _):
+        q = cmd.QuibbleCmd()
+
+        args = q.parse_arguments(args=['--packages-source=composer'])
+        plan = q.build_execution_plan(args)
+
+        clone, _, ext_skin_test, composer_local, native_composer = plan[:5]
+        self.assertIsInstance(
+            ext_skin_test, quibble.commands.ExtSkinComposerNpmTest)
+        self.assertEqual([clone, ext_skin_test], composer_local.depends_on)
+        self.assertEqual([composer_local], native_composer.depends_on)
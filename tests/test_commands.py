@@ -1,80 +1,115 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
-from .util import run_sequentially
+from .util import run_sequentially, SequentialExecutor
 
 import quibble.commands
+import quibble.runner
 
 
+class ZuulCloneCommandTest(unittest.TestCase):
+
+    def test_str(self):
+        c = quibble.commands.ZuulCloneCommand(
+            branch='master', cache_dir=None, project_branch=[],
+            projects=['mediawiki/core'], workers=4, workspace='/src',
+            zuul_branch=None, zuul_newrev=None, zuul_project=None,
+            zuul_ref=None, zuul_url=None)
+
+        with mock.patch('json.dumps', wraps=json.dumps) as mock_dumps:
+            description = str(c)
+            self.assertEqual(description, str(c))
+
+        prefix = 'Zuul clone with parameters '
+        self.assertTrue(description.startswith(prefix))
+        # Dictionaries are not ordered before Python 3.6
+        self.assertEqual(
+            {'branch': 'master', 'projects': ['mediawiki/core'],
+             'workers': 4, 'workspace': '/src'},
+            json.loads(description[len(prefix):]))
+
+        mock_dumps.assert_called_once_with(mock.ANY)
+
+
+@mock.patch('quibble.commands.get_pool', return_value=SequentialExecutor())
 class ExtSkinSubmoduleUpdateCommandTest(unittest.TestCase):
 
-    def test_submodule_update_errors(self):
-        c = quibble.commands.ExtSkinSubmoduleUpdateCommand('/tmp')
-
-        with mock.patch('os.walk') as mock_walk:
-            mock_walk.side_effect = self.walk_extensions
-            with mock.patch('subprocess.check_call') as mock_check_call:
-                # A git command failing aborts.
-                mock_check_call.side_effect = subprocess.CalledProcessError(
-                    1, 'git something')
-                with self.assertRaises(subprocess.CalledProcessError):
-                    c.execute()
-
-                mock_check_call.assert_called_once_with(
-                    ['git', 'submodule', 'foreach',
-                        'git', 'clean', '-xdff', '-q'],
-                    cwd='/tmp/extensions/VisualEditor')
-
-    def test_submodule_update(self):
-        c = quibble.commands.ExtSkinSubmoduleUpdateCommand('/tmp')
-
-        with mock.patch('os.walk') as mock_walk:
-            mock_walk.side_effect = self.walk_extensions
-            with mock.patch('subprocess.check_call') as mock_check_call:
+    submodule_cmd = [
+        'bash', '-ec',
+        'git submodule foreach git clean -xdff -q'
+        ' && git submodule update --init --recursive'
+        ' && git submodule status']
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.mw_install_path = tmpdir.name
+
+        # An extension with submodules, which has a sub directory that also
+        # has submodules, and an extension without submodules.
+        self.visualeditor = os.path.join(
+            self.mw_install_path, 'extensions', 'VisualEditor')
+        os.makedirs(os.path.join(self.visualeditor, 'includes'))
+        open(os.path.join(self.visualeditor, '.gitmodules'), 'w').close()
+        open(os.path.join(self.visualeditor, 'includes', '.gitmodules'),
+             'w').close()
+        os.makedirs(os.path.join(self.mw_install_path, 'extensions', 'Cite'))
+
+    def test_submodule_update_errors(self, *_):
+        c = quibble.commands.ExtSkinSubmoduleUpdateCommand(
+            self.mw_install_path)
+
+        with mock.patch('subprocess.check_call') as mock_check_call:
+            # A git command failing aborts.
+            mock_check_call.side_effect = subprocess.CalledProcessError(
+                1, 'git something')
+            with self.assertRaises(subprocess.CalledProcessError):
                 c.execute()
 
-                mock_check_call.assert_any_call(
-                    ['git', 'submodule', 'foreach',
-                        'git', 'clean', '-xdff', '-q'],
-                    cwd='/tmp/extensions/VisualEditor')
+            mock_check_call.assert_called_once_with(
+                self.submodule_cmd, cwd=self.visualeditor)
 
-                # There should only be three calls, if there are more then we
-                # must have recursed into a sub-subdirectory.
-                self.assertEquals(
-                    3, mock_check_call.call_count,
-                    "Stopped after the first level directory")
+    def test_submodule_update(self, *_):
+        c = quibble.commands.ExtSkinSubmoduleUpdateCommand(
+            self.mw_install_path)
 
-    @staticmethod
-    def walk_extensions(path):
-        if path.endswith('/extensions'):
-            return [
-                ('/tmp/extensions', ['VisualEditor'], []),
-                ('/tmp/extensions/VisualEditor', ['includes'],
-                    ['.gitmodules']),
-            ]
-        else:
-            return []
+        with mock.patch('subprocess.check_call') as mock_check_call:
+            c.execute()
+
+            # There should only be one call, if there are more then we
+            # must have recursed into a sub-subdirectory.
+            mock_check_call.assert_called_once_with(
+                self.submodule_cmd, cwd=self.visualeditor)
 
 
 class CreateComposerLocalTest(unittest.TestCase):
 
-    @mock.patch('json.dump')
-    def test_execute(self, mock_dump):
-        quibble.commands.CreateComposerLocal(
-            '/tmp',
-            ['mediawiki/extensions/Wikibase', 'justinrainbow/jsonschema']
-        ).execute()
+    def test_execute(self):
+        with tempfile.TemporaryDirectory() as mwdir:
+            quibble.commands.CreateComposerLocal(
+                mwdir,
+                ['mediawiki/extensions/Wikibase', 'justinrainbow/jsonschema']
+            ).execute()
+
+            with open(os.path.join(mwdir, 'composer.local.json')) as f:
+                composer_local = json.load(f)
 
-        mock_dump.assert_any_call(
+        self.assertEqual(
             {
                 'extra': {
                     'merge-plugin': {
                         'include': ['extensions/Wikibase/composer.json']
                     }
                 }
-            }, mock.ANY)
+            }, composer_local)
 
 
 class ExtSkinComposerNpmTestTest(unittest.TestCase):
@@ -85,8 +120,18 @@ class ExtSkinComposerNpmTestTest(unittest.TestCase):
     def test_execute_all(self, mock_call, *_):
         quibble.commands.ExtSkinComposerNpmTest('/tmp', True, True).execute()
 
-        mock_call.assert_any_call(['composer', '--ansi', 'test'], cwd='/tmp')
-        mock_call.assert_any_call(['npm', 'test'], cwd='/tmp')
+        mock_call.assert_any_call(
+            ['bash', '-ec',
+             'composer --ansi validate --no-check-publish'
+             ' && composer --ansi install --no-progress --prefer-dist'
+             ' --profile -v'
+             ' && composer --ansi test'],
+            cwd='/tmp')
+        mock_call.assert_any_call(
+            ['bash', '-ec',
+             'npm ci --no-progress --no-audit --prefer-offline'
+             ' && npm test'],
+            cwd='/tmp')
 
     @mock.patch('os.path.exists', return_value=False)
     @mock.patch('quibble.commands.parallel_run', side_effect=run_sequentially)
@@ -115,20 +160,41 @@ class CoreNpmComposerTestTest(unittest.TestCase):
 
         mock_check_call.assert_any_call(['npm', 'test'], cwd='/tmp')
 
+    @mock.patch('quibble.gitchangedinhead.GitChangedInHead.changedFiles',
+                return_value=['foo.php', 'README.md', 'bar.inc'])
+    @mock.patch('subprocess.check_call')
+    def test_composer_test_filters_php_files(self, mock_check_call,
+                                             mock_changed):
+        quibble.commands.CoreNpmComposerTest(
+            '/tmp', True, False).run_composer_test()
 
-class VendorComposerDependenciesTest(unittest.TestCase):
+        mock_changed.assert_called_once_with()
+        mock_check_call.assert_called_once_with(
+            ['composer', 'test', 'foo.php', 'bar.inc'],
+            cwd='/tmp', env=mock.ANY)
 
-    @mock.patch('quibble.util.copylog')
-    @mock.patch('builtins.open', mock.mock_open())
-    @mock.patch('json.load')
+    @mock.patch('quibble.gitchangedinhead.GitChangedInHead.changedFiles',
+                return_value=['composer.json', 'foo.php'])
     @mock.patch('subprocess.check_call')
-    def test_execute(self, mock_check_call, mock_load, *_):
-        mock_load.return_value = {
-            'require-dev': {
-                'justinrainbow/jsonschema': '^1.2.3',
-            }
-        }
+    def test_composer_test_lints_all_on_composer_change(self,
+                                                        mock_check_call, *_):
+        quibble.commands.CoreNpmComposerTest(
+            '/tmp', True, False).run_composer_test()
+
+        mock_check_call.assert_called_once_with(
+            ['composer', 'test', '.'], cwd='/tmp', env=mock.ANY)
 
+
+class VendorComposerDependenciesTest(unittest.TestCase):
+
+    @mock.patch('quibble.commands.copylog')
+    @mock.patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        'require-dev': {
+            'justinrainbow/jsonschema': '^1.2.3',
+        }
+    })))
+    @mock.patch('subprocess.check_call')
+    def test_execute(self, mock_check_call, *_):
         quibble.commands.VendorComposerDependencies('/tmp', '/log').execute()
 
         mock_check_call.assert_any_call(
@@ -137,11 +203,38 @@ class VendorComposerDependenciesTest(unittest.TestCase):
             cwd='/tmp/vendor')
 
 
+class NpmInstallTest(unittest.TestCase):
+
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('subprocess.check_call')
+    def test_execute_with_package_lock(self, mock_check_call, mock_exists):
+        quibble.commands.NpmInstall('/tmp').execute()
+
+        mock_exists.assert_called_once_with('/tmp/package-lock.json')
+        mock_check_call.assert_called_once_with(
+            ['bash', '-ec',
+             'npm ci --no-progress --no-audit --prefer-offline'],
+            cwd='/tmp')
+
+    @mock.patch('os.path.exists', return_value=False)
+    @mock.patch('subprocess.check_call')
+    def test_execute_without_package_lock(self, mock_check_call, *_):
+        quibble.commands.NpmInstall('/tmp').execute()
+
+        mock_check_call.assert_called_once_with(
+            ['bash', '-ec', 'npm prune && npm install --no-progress'],
+            cwd='/tmp')
+
+
 class InstallMediaWikiTest(unittest.TestCase):
 
+    def test_local_settings_is_shipped(self):
+        self.assertTrue(os.path.isfile(quibble.commands.LOCAL_SETTINGS))
+
     @mock.patch('builtins.open', mock.mock_open())
+    @mock.patch('os.replace')
     @mock.patch('quibble.mediawiki.maintenance.rebuildLocalisationCache')
-    @mock.patch('quibble.util.copylog')
+    @mock.patch('quibble.commands.copylog')
     @mock.patch('subprocess.check_call')
     @mock.patch('quibble.backend.getDBClass')
     @mock.patch('quibble.mediawiki.maintenance.install')
@@ -170,38 +263,64 @@ class InstallMediaWikiTest(unittest.TestCase):
             args=['--skip-external-dependencies'],
             mwdir='/tmp')
 
+    @mock.patch('quibble.mediawiki.maintenance.rebuildLocalisationCache')
+    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.backend.getDBClass')
+    @mock.patch('quibble.mediawiki.maintenance.install')
+    @mock.patch('quibble.mediawiki.maintenance.update')
+    def test_prepends_local_settings(self, *_):
+        with tempfile.TemporaryDirectory() as mwdir, \
+                tempfile.TemporaryDirectory() as log_dir:
+            localsettings = os.path.join(mwdir, 'LocalSettings.php')
+            with open(localsettings, 'w') as f:
+                f.write('<?php // installed')
+
+            quibble.commands.InstallMediaWiki(
+                mwdir, 'sqlite', '/db', '/dump', log_dir, False
+            ).execute()
+
+            with open(quibble.commands.LOCAL_SETTINGS) as f:
+                quibble_conf = f.read()
+            with open(localsettings) as f:
+                self.assertEqual(
+                    quibble_conf + '\n?><?php // installed', f.read())
+            self.assertEqual([], [f for f in os.listdir(mwdir)
+                                  if f.endswith('.tmp')])
+
 
 class PhpUnitDatabaseTest(unittest.TestCase):
 
     @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
-    @mock.patch('subprocess.check_call')
-    def test_execute(self, mock_check_call):
+    @mock.patch('quibble.runner.run')
+    def test_execute(self, mock_run):
         quibble.commands.PhpUnitDatabase(
             mw_install_path='/tmp', testsuite='extensions', log_dir='/log'
         ).execute()
 
-        mock_check_call.assert_called_once_with(
+        mock_run.assert_called_once_with(
             ['php', 'tests/phpunit/phpunit.php', '--debug-tests',
              '--testsuite', 'extensions', '--group', 'Database',
              '--exclude-group', 'Broken,ParserFuzz,Stub', '--log-junit',
              '/log/junit-db.xml'],
+            log_file='/log/junit-db.log',
             cwd='/tmp',
             env={'LANG': 'C.UTF-8', 'somevar': '42'})
 
 
 class PhpUnitDatabaselessTest(unittest.TestCase):
 
-    @mock.patch('subprocess.check_call')
-    def test_execute(self, mock_check_call):
+    @mock.patch('quibble.runner.run')
+    def test_execute(self, mock_run):
         quibble.commands.PhpUnitDatabaseless(
             mw_install_path='/tmp', testsuite='extensions', log_dir='/log'
         ).execute()
 
-        mock_check_call.assert_called_once_with(
+        mock_run.assert_called_once_with(
             ['php', 'tests/phpunit/phpunit.php', '--debug-tests',
              '--testsuite', 'extensions', '--exclude-group',
              'Broken,ParserFuzz,Stub,Database', '--log-junit',
              '/log/junit-dbless.xml'],
+            log_file='/log/junit-dbless.log',
             cwd='/tmp',
             env=mock.ANY)
 
@@ -214,6 +333,9 @@ class BrowserTestsTest(unittest.TestCase):
     @mock.patch('subprocess.check_call')
     def test_execute(self, mock_check_call, *_):
         def check_env_for_no_sandbox(cmd, env={}, **_):
+            if cmd[-1] == '--version':
+                # Warming up
+                return
             assert 'CHROMIUM_FLAGS' in env
             assert '--no-sandbox' in env['CHROMIUM_FLAGS']
 
@@ -223,6 +345,47 @@ class BrowserTestsTest(unittest.TestCase):
 
         assert mock_check_call.call_count > 0
 
+    @mock.patch('quibble.backend.DevWebServer')
+    @mock.patch('subprocess.check_call')
+    def test_execute_warms_up_binaries(self, mock_check_call, *_):
+        quibble.commands.BrowserTests('/tmp', True, False, None).execute()
+
+        mock_check_call.assert_any_call(
+            ['node', '--version'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        mock_check_call.assert_any_call(
+            ['/usr/bin/chromium', '--version'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @mock.patch('quibble.commands.ThreadPoolExecutor')
+    @mock.patch('quibble.backend.DevWebServer')
+    def test_execute_warms_up_while_web_server_starts(
+            self, mock_server, mock_executor):
+        calls = mock.Mock()
+        calls.attach_mock(mock_server, 'DevWebServer')
+        calls.attach_mock(mock_executor, 'ThreadPoolExecutor')
+
+        quibble.commands.BrowserTests('/tmp', False, False, None).execute()
+
+        self.assertEqual([
+            mock.call.ThreadPoolExecutor(max_workers=2),
+            mock.call.ThreadPoolExecutor().submit(
+                mock.ANY, ['node', '--version']),
+            mock.call.ThreadPoolExecutor().submit(
+                mock.ANY, ['/usr/bin/chromium', '--version']),
+            mock.call.DevWebServer(mwdir='/tmp', port=mock.ANY),
+            mock.call.DevWebServer().__enter__(),
+            # Warm ups complete before tests are run
+            mock.call.ThreadPoolExecutor().shutdown(wait=True),
+            mock.call.DevWebServer().__exit__(None, None, None),
+        ], calls.mock_calls)
+
+    @mock.patch('subprocess.check_call')
+    def test_warm_up_failure_is_not_fatal(self, mock_check_call):
+        mock_check_call.side_effect = FileNotFoundError()
+
+        quibble.commands.BrowserTests.warm_up(['node', '--version'])
+
 
 class UserCommandsTest(unittest.TestCase):
 
@@ -232,8 +395,39 @@ class UserCommandsTest(unittest.TestCase):
         quibble.commands.UserCommands('/tmp', ['true', 'false']).execute()
 
         mock_check_call.assert_has_calls([
-            mock.call('true', cwd='/tmp', shell=True),
-            mock.call('false', cwd='/tmp', shell=True)])
+            mock.call(['true'], cwd='/tmp'),
+            mock.call(['false'], cwd='/tmp')])
+
+    # Some distributions, such as Fedora, ship a `cd` executable
+    @mock.patch('shutil.which', side_effect=lambda name: (
+        None if name == 'cd' else '/usr/bin/' + name))
+    @mock.patch('quibble.backend.DevWebServer')
+    @mock.patch('subprocess.check_call')
+    def test_commands_using_the_shell(self, mock_check_call, *_):
+        quibble.commands.UserCommands('/tmp', [
+            'cd tests',
+            'echo "$HOME"',
+            'ls -l > /dev/null',
+            'FOO=bar env',
+            'printf "%s" "unterminated',
+        ]).execute()
+
+        mock_check_call.assert_has_calls([
+            mock.call('cd tests', cwd='/tmp', shell=True),
+            mock.call('echo "$HOME"', cwd='/tmp', shell=True),
+            mock.call('ls -l > /dev/null', cwd='/tmp', shell=True),
+            mock.call('FOO=bar env', cwd='/tmp', shell=True),
+            mock.call('printf "%s" "unterminated', cwd='/tmp', shell=True),
+            ])
+
+    @mock.patch('quibble.backend.DevWebServer')
+    @mock.patch('subprocess.check_call')
+    def test_commands_are_split(self, mock_check_call, *_):
+        quibble.commands.UserCommands(
+            '/tmp', ['echo "hello world"']).execute()
+
+        mock_check_call.assert_called_once_with(
+            ['echo', 'hello world'], cwd='/tmp')
 
     @mock.patch('quibble.backend.DevWebServer')
     def test_commands_raises_exception_on_error(self, *_):
@@ -242,3 +436,108 @@ class UserCommandsTest(unittest.TestCase):
 
         with self.assertRaises(subprocess.CalledProcessError, msg=''):
             quibble.commands.UserCommands('/tmp', ['true', 'false']).execute()
+
+
+class ExecutePlanTest(unittest.TestCase):
+
+    @staticmethod
+    def command(**kwargs):
+        return mock.Mock(spec=['execute', 'depends_on'], **kwargs)
+
+    def test_runs_commands_in_order(self):
+        executed = []
+        first = self.command(depends_on=None)
+        first.execute.side_effect = lambda: executed.append('first')
+        second = self.command(depends_on=None)
+        second.execute.side_effect = lambda: executed.append('second')
+
+        quibble.commands.execute_plan([first, second])
+
+        self.assertEqual(['first', 'second'], executed)
+
+    def test_runs_independent_commands_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        first = self.command(depends_on=None)
+        first.execute.side_effect = barrier.wait
+        # Would time out if not run at the same time as the first command
+        second = self.command(depends_on=[])
+        second.execute.side_effect = barrier.wait
+        last = self.command(depends_on=None)
+
+        quibble.commands.execute_plan([first, second, last])
+
+        last.execute.assert_called_once_with()
+
+    def test_stops_on_failure(self):
+        failing = self.command(depends_on=None)
+        failing.execute.side_effect = subprocess.CalledProcessError(1, 'cmd')
+        after = self.command(depends_on=None)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            quibble.commands.execute_plan([failing, after])
+
+        after.execute.assert_not_called()
+
+    def test_terminates_runner_commands_on_failure(self):
+        quibble.runner.start()
+        self.addCleanup(quibble.runner.stop)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pid_file = os.path.join(tmpdir, 'pid')
+            sleeping = self.command(depends_on=None)
+            sleeping.execute.side_effect = lambda: quibble.runner.run(
+                'echo $$ > %s; exec sleep 60' % pid_file, shell=True)
+
+            def fail():
+                while not os.path.exists(pid_file) or \
+                        not os.path.getsize(pid_file):
+                    time.sleep(0.01)
+                quibble.runner.run(['false'])
+            failing = self.command(depends_on=[])
+            failing.execute.side_effect = fail
+
+            start = time.monotonic()
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                quibble.commands.execute_plan([sleeping, failing])
+            self.assertEqual(['false'], cm.exception.cmd)
+            self.assertLess(time.monotonic() - start, 30)
+
+    def test_terminates_runner_commands_on_keyboard_interrupt(self):
+        quibble.runner.start()
+        self.addCleanup(quibble.runner.stop)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pid_file = os.path.join(tmpdir, 'pid')
+            sleeping = self.command(depends_on=None)
+            sleeping.execute.side_effect = lambda: quibble.runner.run(
+                'echo $$ > %s; exec sleep 60' % pid_file, shell=True)
+
+            def interrupt():
+                while not os.path.exists(pid_file) or \
+                        not os.path.getsize(pid_file):
+                    time.sleep(0.01)
+                os.kill(os.getpid(), signal.SIGINT)
+            threading.Thread(target=interrupt, daemon=True).start()
+
+            start = time.monotonic()
+            with self.assertRaises(KeyboardInterrupt):
+                quibble.commands.execute_plan([sleeping])
+            self.assertLess(time.monotonic() - start, 30)
+
+    @mock.patch('quibble.commands.get_pool')
+    def test_creates_pool_only_when_needed(self, mock_get_pool):
+        quibble.commands.execute_plan([self.command(depends_on=None)])
+        mock_get_pool.assert_not_called()
+
+        pool_user = self.command(depends_on=None)
+        pool_user.uses_pool = True
+        quibble.commands.execute_plan([pool_user])
+        mock_get_pool.assert_called_once_with()
+
+    def test_circular_dependencies(self):
+        first = self.command()
+        second = self.command(depends_on=[first])
+        first.depends_on = [second]
+
+        with self.assertRaises(Exception):
+            quibble.commands.execute_plan([first, second])
@@ -0,0 +1,179 @@
+import os
+import signal
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import quibble.runner
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        quibble.runner.start()
+        self.addCleanup(quibble.runner.stop)
+
+    def test_run(self):
+        self.assertEqual(0, quibble.runner.run(['true']))
+
+    def test_run_raises_on_error(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            quibble.runner.run(['false'])
+
+    def test_run_uses_cwd(self):
+        quibble.runner.run('test "$PWD" = /', cwd='/', shell=True)
+
+    def test_run_in_another_directory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            quibble.runner.run(['touch', 'created'], cwd=tmpdir)
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'created')))
+
+    @mock.patch.dict('os.environ', {'QUIBBLE_RUNNER_TEST': '42'})
+    def test_run_passes_current_environment(self):
+        quibble.runner.run('test "$QUIBBLE_RUNNER_TEST" = 42', shell=True)
+
+    def test_run_from_forked_child(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                quibble.runner.run(['true'])
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+
+    def test_run_with_log_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                tempfile.TemporaryFile() as out:
+            log_file = os.path.join(tmpdir, 'phpunit.log')
+            quibble.runner.run(
+                ['sh', '-c', 'seq 1 20000; echo error >&2'],
+                log_file=log_file, stdout=out.fileno(),
+                stderr=subprocess.DEVNULL)
+            out.seek(0)
+            output = out.read()
+
+            expected = ''.join('%s\n' % i for i in range(1, 20001))
+            self.assertEqual(expected.encode(), output)
+            with open(log_file, 'rb') as f:
+                self.assertEqual(expected.encode(), f.read())
+
+    def test_run_with_log_file_raises_on_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                tempfile.TemporaryFile() as out:
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                quibble.runner.run(
+                    ['false'], log_file=os.path.join(tmpdir, 'phpunit.log'),
+                    stdout=out.fileno())
+            self.assertEqual(1, cm.exception.returncode)
+
+    def test_run_with_log_file_to_append_mode_output(self):
+        # sendfile() does not support an output in append mode
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_file = os.path.join(tmpdir, 'build.log')
+            with open(out_file, 'w') as f:
+                f.write('previous build\n')
+
+            out_fd = os.open(out_file, os.O_WRONLY | os.O_APPEND)
+            try:
+                quibble.runner.run(
+                    ['echo', 'hello'],
+                    log_file=os.path.join(tmpdir, 'phpunit.log'),
+                    stdout=out_fd)
+            finally:
+                os.close(out_fd)
+
+            with open(out_file) as f:
+                self.assertEqual('previous build\nhello\n', f.read())
+
+    def test_command_is_terminated_when_caller_goes_away(self):
+        self.assert_terminated_when_caller_goes_away(
+            'echo $$ > {pid_file}; exec sleep 60', shell=True)
+
+    def test_chained_commands_are_terminated_when_caller_goes_away(self):
+        # sleep is not the process spawned by the helper
+        self.assert_terminated_when_caller_goes_away(
+            ['bash', '-ec',
+             "sh -c 'echo $$ > {pid_file}; exec sleep 61' && true"])
+
+    def assert_terminated_when_caller_goes_away(self, cmd, **kwargs):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pid_file = os.path.join(tmpdir, 'pid')
+            if isinstance(cmd, str):
+                cmd = cmd.format(pid_file=pid_file)
+            else:
+                cmd = [arg.format(pid_file=pid_file) for arg in cmd]
+
+            pid = os.fork()
+            if pid == 0:
+                # Never returns, the child gets killed.
+                quibble.runner.run(cmd, **kwargs)
+                os._exit(1)
+
+            while not os.path.exists(pid_file) or \
+                    not os.path.getsize(pid_file):
+                time.sleep(0.01)
+            with open(pid_file) as f:
+                sleep_pid = int(f.read())
+
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+            for _ in range(500):
+                if not is_running(sleep_pid):
+                    break
+                time.sleep(0.01)
+            else:
+                os.kill(sleep_pid, signal.SIGKILL)
+                self.fail('Command has not been terminated')
+
+
+def is_running(pid):
+    # An orphan might not be reaped, ignore zombies.
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            return f.read().split()[2] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+class RunnerFallbackTest(unittest.TestCase):
+
+    @mock.patch('subprocess.check_call')
+    def test_run_without_helper(self, mock_check_call):
+        quibble.runner.run(['true'], cwd='/tmp')
+
+        mock_check_call.assert_called_once_with(['true'], cwd='/tmp')
+
+    def test_run_with_log_file_without_helper(self):
+        os_without_splice = mock.Mock(
+            wraps=os, spec=[attr for attr in dir(os)
+                            if attr not in ('splice', 'sendfile')])
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                tempfile.TemporaryFile() as out, \
+                mock.patch('quibble.runner.os', os_without_splice):
+            log_file = os.path.join(tmpdir, 'phpunit.log')
+            quibble.runner.run(['echo', 'ok'], log_file=log_file,
+                               stdout=out.fileno())
+            out.seek(0)
+            self.assertEqual(b'ok\n', out.read())
+            with open(log_file, 'rb') as f:
+                self.assertEqual(b'ok\n', f.read())
+
+    @mock.patch('quibble.runner._tee', side_effect=OSError('Broken'))
+    def test_run_with_log_file_kills_command_on_error(self, _):
+        start = time.monotonic()
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                tempfile.TemporaryFile() as out:
+            with self.assertRaisesRegex(OSError, 'Broken'):
+                quibble.runner.run(
+                    ['sleep', '60'],
+                    log_file=os.path.join(tmpdir, 'phpunit.log'),
+                    stdout=out.fileno())
+
+        self.assertLess(time.monotonic() - start, 30)
@@ -1,6 +1,57 @@
+import json
+import time
+from unittest import mock
+
 import quibble.util
 
 
 def test_parallel_run_accepts_an_empty_list_of_tasks():
     quibble.util.parallel_run([])
     assert True
+
+
+def test_parallel_run_uses_given_executor():
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert quibble.util.parallel_run(
+            [(calls.append, 'a'), (calls.append, 'b')], executor=executor)
+    assert sorted(calls) == ['a', 'b']
+
+
+def test_parallel_run_reuses_the_shared_pool():
+    quibble.util.parallel_run([(len, 'x')])
+    pool = quibble.util.get_pool()
+    quibble.util.parallel_run([(len, 'y')])
+    assert quibble.util.get_pool() is pool
+
+
+def test_json_roundtrip():
+    data = {'require-dev': {'justinrainbow/jsonschema': '^1.2.3'}}
+    assert quibble.util.json_loads(quibble.util.json_dumps(data)) == data
+
+
+@mock.patch('quibble.util.orjson', None)
+def test_json_without_orjson():
+    data = {'extra': {'merge-plugin': {'include': []}}}
+    assert quibble.util.json_dumps(data) == json.dumps(data)
+    assert quibble.util.json_loads(json.dumps(data)) == data
+
+
+def fail():
+    raise Exception('Task failed')
+
+
+def test_parallel_run_stops_on_first_failure():
+    start = time.monotonic()
+    try:
+        quibble.util.parallel_run([(time.sleep, 60), (fail, )])
+    except Exception as e:
+        assert str(e) == 'Task failed'
+    else:
+        raise AssertionError('Exception not raised')
+
+    assert time.monotonic() - start < 30
+    # A new pool is created for the next run
+    assert quibble.util.parallel_run([(len, 'x')])
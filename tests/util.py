@@ -1,6 +1,13 @@
 def run_sequentially(tasks):
-    '''Replace imap_unordered with sequential execution'''
+    '''Replace parallel_run with sequential execution'''
     for func_spec in tasks:
         func = func_spec[0]
         args = func_spec[1:]
         func(*args)
+
+
+class SequentialExecutor:
+    '''Replace an executor with sequential execution'''
+
+    def map(self, func, *iterables, **kwargs):
+        return map(func, *iterables)